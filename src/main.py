@@ -1,10 +1,15 @@
 # Bot to monitor channels and replace social media links with prettier formatting
 
+import io
 import os
 import re
+import queue
 import asyncio
+import logging
+import logging.handlers
 from typing import Dict, List, Tuple, Optional, Callable
-from collections import defaultdict
+from collections import OrderedDict
+from dataclasses import dataclass
 import discord
 from dotenv import load_dotenv
 
@@ -18,36 +23,85 @@ intents.message_content = True
 
 client = discord.Client(intents=intents)
 
-# Per-channel locks to prevent race conditions
-channel_locks = defaultdict(asyncio.Lock)
-
-# Track recently processed message IDs to avoid loops
-recently_processed = set()
+# Log through a queue so the event loop never blocks on stream writes;
+# a background listener thread does the actual I/O
+log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+logger = logging.getLogger("prettier_social")
+logger.setLevel(logging.INFO)
+logger.propagate = False
+logger.addHandler(logging.handlers.QueueHandler(log_queue))
+log_listener = logging.handlers.QueueListener(log_queue, logging.StreamHandler())
+
+# Track recently processed message IDs to avoid loops (oldest first)
+recently_processed: "OrderedDict[int, None]" = OrderedDict()
 MAX_PROCESSED_CACHE = 1000
 
+# Cached manage_messages permission per channel ID, dropped on role/channel
+# changes and when the bot joins or leaves a guild
+_can_delete_cache: Dict[int, bool] = {}
+
+# Upload limit for channels without a guild (e.g. DMs)
+DEFAULT_FILESIZE_LIMIT = 10 * 1024 * 1024
+
+# One pattern classifying every supported link in a single scan of the content.
+# The named group of each alternative tells which provider matched. The shared
+# "https://" literal is kept outside the alternation so the regex engine can
+# jump between scheme occurrences with its literal-prefix search instead of
+# trying every alternative at every position. No quantifier overlaps the
+# literal that follows it, so matching stays linear in the content length;
+# the handle run is capped at X's 15 character limit so a long non-link
+# word is given up on after a bounded number of steps.
+_LINK_RE = re.compile(
+    r"https://(?P<www>www\.)?(?:"
+    r"(?P<tw>(?:x|twitter)\.com/(?P<tw_user>[a-zA-Z0-9_]{1,15})/status/(?P<tw_id>[0-9]+))"
+    r"|(?P<rd>reddit\.com(?P<rd_path>[^\s]*))"
+    r"|(?P<tt>tiktok\.com(?P<tt_path>[^\s]*))"
+    r")"
+)
 
-# ==================== UTILITY FUNCTIONS ====================
-
-def is_bot_message_or_from_self(message: discord.Message) -> bool:
-    """Check if message is from a bot, webhook, or self."""
-    return message.author.bot or message.webhook_id is not None
 
+# ==================== UTILITY FUNCTIONS ====================
 
 def build_link_button(original_url: str, label: str) -> discord.ui.View:
     """Create a view with a link button to the original URL."""
     button = discord.ui.Button(style=discord.ButtonStyle.link, url=original_url, label=label)
     view = discord.ui.View()
     view.add_item(button)
+    # Link buttons never send interactions; a finished view is not kept in
+    # the client's view store after sending (discord.py < 2.6 stores any
+    # unfinished view until its timeout fires)
+    view.stop()
     return view
 
 
+def fits_upload_limit(channel: discord.TextChannel, attachment: discord.Attachment) -> bool:
+    """Check if an attachment is small enough to be re-uploaded to the channel."""
+    guild = getattr(channel, "guild", None)
+    limit = guild.filesize_limit if guild else DEFAULT_FILESIZE_LIMIT
+    return attachment.size <= limit
+
+
 async def can_delete_messages(channel: discord.TextChannel) -> bool:
     """Check if bot has permission to delete messages in the channel."""
+    # Threads inherit permissions from their parent, so share its entry
+    cache_key = getattr(channel, "parent_id", None) or channel.id
+    cached = _can_delete_cache.get(cache_key)
+    if cached is not None:
+        return cached
+    
     try:
         permissions = channel.permissions_for(channel.guild.me)
-        return permissions.manage_messages
     except Exception:
         return False
+    
+    _can_delete_cache[cache_key] = permissions.manage_messages
+    return permissions.manage_messages
+
+
+def invalidate_permission_cache(guild: discord.Guild) -> None:
+    """Forget cached permissions for every channel in the guild."""
+    for channel in guild.channels:
+        _can_delete_cache.pop(channel.id, None)
 
 
 async def send_preserved_message(
@@ -59,243 +113,227 @@ async def send_preserved_message(
 ) -> Optional[discord.Message]:
     """Send the rewritten message with preserved content and attachments."""
     try:
-        # Format message with author name
-        formatted_content = f"{author_name}: {new_content}"
-        
-        # Discord has a 2000 character limit
-        if len(formatted_content) > 2000:
-            formatted_content = formatted_content[:1997] + "..."
+        # Format message with author name, trimming the content to fit
+        # Discord's 2000 character limit before joining
+        prefix = author_name + ": "
+        budget = 2000 - len(prefix)
+        if len(new_content) > budget:
+            new_content = new_content[:budget - 3] + "..."
+        formatted_content = prefix + new_content
         
         # Prepare files from attachments
         files = []
         if attachments:
+            # Never download what the channel would reject on upload
+            uploadable = []
             for attachment in attachments:
-                try:
-                    # Download and re-attach files
-                    file_data = await attachment.read()
-                    files.append(discord.File(fp=file_data, filename=attachment.filename))
-                except Exception as e:
-                    print(f"Failed to re-attach file {attachment.filename}: {e}")
+                if fits_upload_limit(channel, attachment):
+                    uploadable.append(attachment)
+                else:
+                    logger.warning("Skipping oversized file %s (%d bytes)", attachment.filename, attachment.size)
+            
+            # Download all attachments concurrently and re-attach them
+            results = await asyncio.gather(
+                *(attachment.read() for attachment in uploadable),
+                return_exceptions=True
+            )
+            for attachment, file_data in zip(uploadable, results):
+                if isinstance(file_data, BaseException):
+                    logger.warning("Failed to re-attach file %s: %s", attachment.filename, file_data)
+                    continue
+                files.append(discord.File(fp=io.BytesIO(file_data), filename=attachment.filename))
         
         # Send the message
         return await channel.send(content=formatted_content, view=view, files=files if files else None)
     
     except discord.Forbidden:
-        print(f"Missing permissions to send message in channel {channel.id}")
+        logger.warning("Missing permissions to send message in channel %s", channel.id)
         return None
     except discord.HTTPException as e:
-        print(f"HTTP error sending message: {e}")
+        logger.warning("HTTP error sending message: %s", e)
         return None
     except Exception as e:
-        print(f"Unexpected error sending message: {e}")
+        logger.warning("Unexpected error sending message: %s", e)
         return None
 
 
-# ==================== HANDLER FUNCTIONS ====================
+# ==================== REWRITE FUNCTIONS ====================
 
-async def handle_twitter(message: discord.Message, content: str) -> Optional[Dict]:
-    """Handle Twitter/X link rewriting."""
-    # Skip if already rewritten
-    if "fxtwitter.com" in content:
-        return None
-    
-    # Check if Twitter/X link exists
-    if not any(domain in content for domain in ["https://x.com", "https://twitter.com", "https://www.x.com", "https://www.twitter.com"]):
-        return None
-    
-    # Regex pattern from pingbot
-    pattern = r"https://(www\.)?(x|twitter)\.com/([a-zA-Z0-9_]+)/status/([0-9]+)"
-    
-    new_content = re.sub(
-        pattern,
-        r"https://fxtwitter.com/\3/status/\4",
-        content
-    )
-    
-    if new_content == content:
-        return None
-    
-    # Find original link for the button
-    match = re.search(pattern, content)
-    if match:
-        original_link = f"https://{match.group(1) or ''}{'x' if match.group(2) == 'x' else 'twitter'}.com/{match.group(3)}/status/{match.group(4)}"
-        view = build_link_button(original_link, "Open in X")
-        
-        return {
-            "new_text": new_content,
-            "original_url": original_link,
-            "view": view,
-            "delete_original": True
-        }
-    
-    return None
+def rewrite_twitter(match: re.Match) -> str:
+    """Build the fxtwitter link for a Twitter/X match."""
+    return f"https://fxtwitter.com/{match.group('tw_user')}/status/{match.group('tw_id')}"
 
 
-async def handle_reddit(message: discord.Message, content: str) -> Optional[Dict]:
-    """Handle Reddit link rewriting."""
-    # Skip if already rewritten
-    if "vxreddit.com" in content:
-        return None
-    
-    # Check if Reddit link exists
-    if not any(domain in content for domain in ["https://reddit.com", "https://www.reddit.com"]):
-        return None
-    
-    # Regex pattern from pingbot
-    pattern = r"https://(www\.)?reddit\.com"
-    
-    new_content = re.sub(
-        pattern,
-        r"https://vxreddit.com",
-        content
-    )
-    
-    if new_content == content:
-        return None
-    
-    # Find original link for the button
-    match = re.search(r"https://(www\.)?reddit\.com[^\s]*", content)
-    if match:
-        original_link = match.group(0)
-        view = build_link_button(original_link, "Open in Reddit")
-        
-        return {
-            "new_text": new_content,
-            "original_url": original_link,
-            "view": view,
-            "delete_original": True
-        }
-    
-    return None
+def rewrite_reddit(match: re.Match) -> str:
+    """Build the vxreddit link for a Reddit match."""
+    return f"https://vxreddit.com{match.group('rd_path')}"
 
 
-async def handle_tiktok(message: discord.Message, content: str) -> Optional[Dict]:
-    """Handle TikTok link rewriting."""
-    # Skip if already rewritten
-    if "tnktok.com" in content:
-        return None
-    
-    # Check if TikTok link exists
-    if not any(domain in content for domain in ["https://tiktok.com", "https://www.tiktok.com"]):
-        return None
-    
-    # Regex pattern from pingbot
-    pattern = r"https://(www\.)?tiktok\.com"
-    
-    new_content = re.sub(
-        pattern,
-        r"https://\1tnktok.com",
-        content
-    )
+def rewrite_tiktok(match: re.Match) -> str:
+    """Build the tnktok link for a TikTok match."""
+    return f"https://{match.group('www') or ''}tnktok.com{match.group('tt_path')}"
+
+
+# ==================== REWRITER REGISTRY ====================
+
+# _LINK_RE group name -> (rewrite function, button label)
+REWRITERS: Dict[str, Tuple[Callable[[re.Match], str], str]] = {
+    "tw": (rewrite_twitter, "Open in X"),
+    "rd": (rewrite_reddit, "Open in Reddit"),
+    "tt": (rewrite_tiktok, "Open in TikTok"),
+}
+
+
+@dataclass(slots=True)
+class RewriteResult:
+    """Rewritten message text plus the button linking back to the original."""
+    new_text: str
+    original_url: str
+    view: discord.ui.View
+    delete_original: bool = True
+
+
+def rewrite_links(content: str) -> Optional[RewriteResult]:
+    """Rewrite every supported link in the content in a single scan."""
+    pieces = []
+    last = 0
+    first_match = None
+    for match in _LINK_RE.finditer(content):
+        if first_match is None:
+            first_match = match
+        rewrite, _ = REWRITERS[match.lastgroup]
+        pieces.append(content[last:match.start()])
+        pieces.append(rewrite(match))
+        last = match.end()
     
-    if new_content == content:
+    if first_match is None:
         return None
+    pieces.append(content[last:])
+    new_content = "".join(pieces)
     
-    # Find original link for the button
-    match = re.search(r"https://(www\.)?tiktok\.com[^\s]*", content)
-    if match:
-        original_link = match.group(0)
-        view = build_link_button(original_link, "Open in TikTok")
-        
-        return {
-            "new_text": new_content,
-            "original_url": original_link,
-            "view": view,
-            "delete_original": True
-        }
+    # The button points back to the first link in the message
+    original_link = first_match.group(0)
+    _, label = REWRITERS[first_match.lastgroup]
+    view = build_link_button(original_link, label)
     
-    return None
+    return RewriteResult(new_text=new_content, original_url=original_link, view=view)
 
 
-# ==================== HANDLER REGISTRY ====================
+# ==================== MAIN MESSAGE HANDLER ====================
 
-def get_handlers() -> List[Callable]:
-    """Return the list of handler functions to check in order."""
-    return [
-        handle_twitter,
-        handle_reddit,
-        handle_tiktok,
-    ]
+@client.event
+async def on_ready():
+    logger.info("Bot logged in as %s", client.user)
+    logger.info("Active in %d servers", len(client.guilds))
 
 
-# ==================== MAIN MESSAGE HANDLER ====================
+@client.event
+async def on_guild_channel_update(before: discord.abc.GuildChannel, after: discord.abc.GuildChannel):
+    _can_delete_cache.pop(after.id, None)
+
 
 @client.event
-async def on_ready():
-    print(f"Bot logged in as {client.user}")
-    print(f"Active in {len(client.guilds)} servers")
+async def on_guild_channel_delete(channel: discord.abc.GuildChannel):
+    _can_delete_cache.pop(channel.id, None)
+
+
+@client.event
+async def on_guild_role_update(before: discord.Role, after: discord.Role):
+    invalidate_permission_cache(after.guild)
+
+
+@client.event
+async def on_guild_role_delete(role: discord.Role):
+    invalidate_permission_cache(role.guild)
+
+
+@client.event
+async def on_guild_join(guild: discord.Guild):
+    # A re-invite can come with new roles but keeps the same channel IDs
+    invalidate_permission_cache(guild)
+
+
+@client.event
+async def on_guild_remove(guild: discord.Guild):
+    invalidate_permission_cache(guild)
+
+
+@client.event
+async def on_member_update(before: discord.Member, after: discord.Member):
+    # The bot's own roles changed
+    if after.id == client.user.id:
+        invalidate_permission_cache(after.guild)
 
 
 @client.event
 async def on_message(message: discord.Message):
-    # Ignore bot messages, webhooks, and self
-    if is_bot_message_or_from_self(message):
+    content = message.content
+    
+    # Ignore bot messages, webhooks, self, and empty messages in one
+    # short-circuiting check
+    if message.author.bot or message.webhook_id is not None or not content:
         return
     
-    # Ignore recently processed messages to avoid loops
-    if message.id in recently_processed:
+    # Most messages carry no link at all; skip them before any regex work
+    if "https://" not in content:
         return
     
-    # Ignore empty messages
-    if not message.content:
+    # Ignore recently processed messages to avoid loops; only linked
+    # messages can have been processed, so check after the link gate
+    if message.id in recently_processed:
         return
     
-    # Acquire per-channel lock to prevent race conditions
-    async with channel_locks[message.channel.id]:
-        # Try each handler in order
-        handlers = get_handlers()
+    try:
+        result = rewrite_links(content)
         
-        for handler in handlers:
-            try:
-                result = await handler(message, message.content)
-                
-                if result is None:
-                    continue
-                
-                # Handler matched and returned a result
-                new_text = result.get("new_text")
-                view = result.get("view")
-                delete_original = result.get("delete_original", False)
-                
-                if not new_text:
-                    continue
-                
-                # Send the preserved message
-                sent_message = await send_preserved_message(
-                    channel=message.channel,
-                    author_name=message.author.display_name,
-                    new_content=new_text,
-                    view=view,
-                    attachments=message.attachments if message.attachments else None
+        if result is None:
+            return
+        
+        delete_original = result.delete_original
+        
+        # Send the preserved message
+        sent_message = await send_preserved_message(
+            channel=message.channel,
+            author_name=message.author.display_name,
+            new_content=result.new_text,
+            view=result.view,
+            attachments=message.attachments if message.attachments else None
+        )
+        
+        if sent_message:
+            # Track that message was processed
+            for processed_id in (message.id, sent_message.id):
+                recently_processed[processed_id] = None
+                recently_processed.move_to_end(processed_id)
+            
+            # Maintain cache size by evicting the oldest entries
+            while len(recently_processed) > MAX_PROCESSED_CACHE:
+                recently_processed.popitem(last=False)
+            
+            # Keep the original if any attachment could not be carried over
+            if delete_original:
+                delete_original = all(
+                    fits_upload_limit(message.channel, attachment)
+                    for attachment in message.attachments
                 )
-                
-                if sent_message:
-                    # Track that message was processed
-                    recently_processed.add(message.id)
-                    recently_processed.add(sent_message.id)
-                    
-                    # Maintain cache size
-                    if len(recently_processed) > MAX_PROCESSED_CACHE:
-                        # Remove oldest
-                        recently_processed.pop()
-                    
-                    # Delete original if requested
-                    if delete_original and await can_delete_messages(message.channel):
-                        try:
-                            await message.delete()
-                        except discord.NotFound:
-                            pass
-                        except discord.Forbidden:
-                            print(f"Missing permission to delete message in channel {message.channel.id}")
-                        except discord.HTTPException as e:
-                            print(f"HTTP error deleting message: {e}")
-                
-                # Only process first matching handler
-                break
             
-            except Exception as e:
-                print(f"Error in handler {handler.__name__}: {e}")
-                continue
+            # Delete original if requested
+            if delete_original and await can_delete_messages(message.channel):
+                try:
+                    await message.delete()
+                except discord.NotFound:
+                    pass
+                except discord.Forbidden:
+                    logger.warning("Missing permission to delete message in channel %s", message.channel.id)
+                except discord.HTTPException as e:
+                    logger.warning("HTTP error deleting message: %s", e)
+    
+    except Exception as e:
+        logger.warning("Error rewriting message %s: %s", message.id, e)
 
 
-client.run(TOKEN)
\ No newline at end of file
+log_listener.start()
+try:
+    client.run(TOKEN)
+finally:
+    log_listener.stop()